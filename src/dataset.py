@@ -3,6 +3,9 @@ import random
 import pickle
 import torch
 import numpy as np
+from torch.utils.data import BatchSampler, SequentialSampler
+from torch_geometric.nn.conv.gcn_conv import gcn_norm
+from torch_geometric.utils import to_torch_csr_tensor
 from utils import get_data_from_path
 
 
@@ -90,114 +93,240 @@ class Dataset:
         self.number_of_node_labels = len(self.global_node_labels)
         self.number_of_edge_labels = len(self.global_edge_labels)
 
+        # graph tensors by graph id, filled on first use
+        self.graph_tensors = dict()
+
     def get_training_graphs(self):
         return self.training_graphs
 
     def get_test_graphs(self):
         return self.test_graphs
 
-    def get_data(self, graph_index_pair, mode="training"):
-        data = dict()
+    def get_graph_pair(self, graph_index_pair, mode="training"):
         if mode == "training" or mode == "validation":
             g_1 = self.training_graphs[graph_index_pair[0]]
             g_2 = self.training_graphs[graph_index_pair[1]]
         else:
             g_1 = self.test_graphs[graph_index_pair[0]]
             g_2 = self.training_graphs[graph_index_pair[1]]
+        return g_1, g_2
 
-        graph_pair = dict()
-        graph_pair["graph_1"] = g_1.get("graph")
-        graph_pair["graph_2"] = g_2.get("graph")
-        graph_pair["labels_1"] = g_1.get("labels")
-        graph_pair["labels_2"] = g_2.get("labels")
-        graph_pair["ged"] = self.ged_dict.get((g_1.get("id"), g_2.get("id")))
-
-        data["graph_1"] = graph_pair["graph_1"]
-        data["graph_2"] = graph_pair["graph_2"]
-
-        trans_edge_index_1 = []
-        for edge_index_1, edge_1 in enumerate(graph_pair["graph_1"]):
-            for edge_index_2, edge_2 in enumerate(graph_pair["graph_1"]):
-                if edge_1[0] == edge_2[0] or edge_1[0] == edge_2[1] or edge_1[1] == edge_2[0] or edge_1[1] == edge_2[1]:
-                    trans_edge_index_1.append([edge_index_1, edge_index_2])
-        data["trans_edge_index_1"] = trans_edge_index_1
+    def get_graph_data(self, graph):
+        data = dict()
+        data["graph"] = graph.get("graph")
 
-        trans_edge_index_2 = []
-        for edge_index_1, edge_1 in enumerate(graph_pair["graph_2"]):
-            for edge_index_2, edge_2 in enumerate(graph_pair["graph_2"]):
+        trans_edge_index = []
+        for edge_index_1, edge_1 in enumerate(data["graph"]):
+            for edge_index_2, edge_2 in enumerate(data["graph"]):
                 if edge_1[0] == edge_2[0] or edge_1[0] == edge_2[1] or edge_1[1] == edge_2[0] or edge_1[1] == edge_2[1]:
-                    trans_edge_index_2.append([edge_index_1, edge_index_2])
-        data["trans_edge_index_2"] = trans_edge_index_2
+                    trans_edge_index.append([edge_index_1, edge_index_2])
+        data["trans_edge_index"] = trans_edge_index
 
         # process node labels
-        data["node_labels_1"] = graph_pair["labels_1"]
-        data["node_labels_2"] = graph_pair["labels_2"]
+        data["node_labels"] = graph.get("labels")
 
         # process edge labels
-        edge_labels_1 = []
-        edge_labels_2 = []
-        for edge in graph_pair["graph_1"]:
-            edge_labels_1.append(tuple(sorted([graph_pair["labels_1"][edge[0]], graph_pair["labels_1"][edge[1]]])))
-        for edge in graph_pair["graph_2"]:
-            edge_labels_2.append(tuple(sorted([graph_pair["labels_2"][edge[0]], graph_pair["labels_2"][edge[1]]])))
-        data["edge_labels_1"] = edge_labels_1
-        data["edge_labels_2"] = edge_labels_2
-
-        data["ged"] = graph_pair["ged"]
+        edge_labels = []
+        for edge in data["graph"]:
+            edge_labels.append(tuple(sorted([data["node_labels"][edge[0]], data["node_labels"][edge[1]]])))
+        data["edge_labels"] = edge_labels
         return data
 
-    def transfer_to_torch(self, data):
-        new_data = dict()
-
-        edges_1 = data["graph_1"] + [[y, x] for x, y in data["graph_1"]]
-        edges_2 = data["graph_2"] + [[y, x] for x, y in data["graph_2"]]
+    def get_target(self, graph_index_pair, mode="training"):
+        g_1, g_2 = self.get_graph_pair(graph_index_pair, mode=mode)
+        ged = self.ged_dict.get((g_1.get("id"), g_2.get("id")))
+        norm_ged = ged / (0.5 * (len(g_1.get("labels")) + len(g_2.get("labels"))))
+        return np.exp(-norm_ged)
 
-        new_data["edge_index_1"] = torch.from_numpy(np.array(edges_1, dtype=np.int64).T).type(torch.long) \
-            .to(self.args.device)
-        new_data["edge_index_2"] = torch.from_numpy(np.array(edges_2, dtype=np.int64).T).type(torch.long) \
-            .to(self.args.device)
+    def graph_to_torch(self, data):
+        new_data = dict()
 
-        trans_edges_1 = data["trans_edge_index_1"] + [[y, x] for x, y in data["trans_edge_index_1"]]
-        trans_edges_2 = data["trans_edge_index_2"] + [[y, x] for x, y in data["trans_edge_index_2"]]
-        new_data["trans_edge_index_1"] = torch.from_numpy(np.array(trans_edges_1, dtype=np.int64).T).type(torch.long) \
-            .to(self.args.device)
-        new_data["trans_edge_index_2"] = torch.from_numpy(np.array(trans_edges_2, dtype=np.int64).T).type(torch.long) \
-            .to(self.args.device)
+        edges = data["graph"] + [[y, x] for x, y in data["graph"]]
+        new_data["edge_index"] = torch.from_numpy(np.array(edges, dtype=np.int64).T).type(torch.long)
 
-        node_features_1, node_features_2 = [], []
-        for n in data["node_labels_1"]:
-            node_features_1.append(
-                [1.0 if self.global_node_labels[n] == i else 0.0 for i in self.global_node_labels.values()])
+        trans_edges = data["trans_edge_index"] + [[y, x] for x, y in data["trans_edge_index"]]
+        new_data["trans_edge_index"] = torch.from_numpy(np.array(trans_edges, dtype=np.int64).T).type(torch.long)
 
-        for n in data["node_labels_2"]:
-            node_features_2.append(
+        node_features = []
+        for n in data["node_labels"]:
+            node_features.append(
                 [1.0 if self.global_node_labels[n] == i else 0.0 for i in self.global_node_labels.values()])
+        new_data["node_features"] = torch.FloatTensor(np.array(node_features))
 
-        new_data["node_features_1"] = torch.FloatTensor(np.array(node_features_1)).to(self.args.device)
-        new_data["node_features_2"] = torch.FloatTensor(np.array(node_features_2)).to(self.args.device)
-
-        edge_features_1, edge_features_2 = [], []
-        for n in data['edge_labels_1']:
+        edge_features = []
+        for n in data["edge_labels"]:
             if self.global_edge_labels.get(n) is None:
-                tar_feature_1 = [0.0] * len(self.global_edge_labels)
-                tar_feature_1[self.global_edge_labels[("Z-Others", "Z-Others")]] = 1.0
-                edge_features_1.append(tar_feature_1)
+                tar_feature = [0.0] * len(self.global_edge_labels)
+                tar_feature[self.global_edge_labels[("Z-Others", "Z-Others")]] = 1.0
+                edge_features.append(tar_feature)
             else:
-                edge_features_1.append(
-                    [1.0 if self.global_edge_labels[n] == i else 0.0 for i in self.global_edge_labels.values()])
-        for n in data['edge_labels_2']:
-            if self.global_edge_labels.get(n) is None:
-                tar_feature_2 = [0.0] * len(self.global_edge_labels)
-                tar_feature_2[self.global_edge_labels[("Z-Others", "Z-Others")]] = 1.0
-                edge_features_2.append(tar_feature_2)
-            else:
-                edge_features_2.append(
+                edge_features.append(
                     [1.0 if self.global_edge_labels[n] == i else 0.0 for i in self.global_edge_labels.values()])
+        new_data["edge_features"] = torch.FloatTensor(np.array(edge_features))
+        return new_data
+
+    def get_graph_tensors(self, graph):
+        """
+        Memoized graph_to_torch of a graph: one-hot features and (line graph) edge indices
+        are built once per graph, instead of once per pair the graph is part of.
+        :param graph: Graph of training_graphs or test_graphs.
+        :return new_data: Tensors of the graph.
+        """
+        new_data = self.graph_tensors.get(graph.get("id"))
+        if new_data is None:
+            new_data = self.graph_to_torch(self.get_graph_data(graph))
+            self.graph_tensors[graph.get("id")] = new_data
+        return new_data
 
-        new_data["edge_features_1"] = torch.FloatTensor(np.array(edge_features_1)).to(self.args.device)
-        new_data["edge_features_2"] = torch.FloatTensor(np.array(edge_features_2)).to(self.args.device)
 
-        norm_ged = data["ged"] / (0.5 * (len(data["node_labels_1"]) + len(data["node_labels_2"])))
+def join_graphs(graph_1, graph_2):
+    """
+    Building a graph pair from the entries of its two graphs, suffixed by "_1" and "_2".
+    """
+    data = dict()
+    for side, graph in (("1", graph_1), ("2", graph_2)):
+        for key, value in graph.items():
+            data[key + "_" + side] = value
+    return data
 
-        new_data["target"] = torch.from_numpy(np.exp(-norm_ged).reshape(1, 1)).view(-1).float().to(self.args.device)
+
+class PairDataset(torch.utils.data.Dataset):
+    """
+    Graph pairs of one split, as consumed by a DataLoader. Pairs are built on the CPU
+    (possibly in worker processes) from the memoized graph tensors of the Dataset, and
+    moved to the device by the trainer.
+    """
+
+    def __init__(self, dataset, graph_index_pairs, mode="training"):
+        """
+        :param dataset: Dataset object.
+        :param graph_index_pairs: Graph index pairs of the split.
+        :param mode: "training", "validation" or "test".
+        """
+        self.dataset = dataset
+        self.graph_index_pairs = graph_index_pairs
+        self.mode = mode
+
+    def __len__(self):
+        return len(self.graph_index_pairs)
+
+    def __getitem__(self, index):
+        graph_index_pair = self.graph_index_pairs[index]
+        g_1, g_2 = self.dataset.get_graph_pair(graph_index_pair, mode=self.mode)
+        new_data = join_graphs(self.dataset.get_graph_tensors(g_1), self.dataset.get_graph_tensors(g_2))
+        new_data["target"] = torch.tensor([self.dataset.get_target(graph_index_pair, mode=self.mode)],
+                                          dtype=torch.float)
         return new_data
+
+
+class DevicePairLoader:
+    """
+    Batches of graph pairs assembled from graph tensors which already live on the device.
+    Small datasets are uploaded once, so that batches need neither loader workers nor
+    host to device copies.
+    """
+
+    def __init__(self, dataset, graph_index_pairs, graphs_1, graphs_2, mode="training", batch_size=128,
+                 batch_sampler=None, sparse_adjacency=True):
+        """
+        :param dataset: Dataset object.
+        :param graph_index_pairs: Graph index pairs of the split.
+        :param graphs_1: Tensors (Dataset.graph_to_torch) of the graphs the first pair indices refer to.
+        :param graphs_2: Same for the second pair indices.
+        :param mode: "training", "validation" or "test".
+        :param batch_size: Number of graph pairs per batch, when no batch sampler is given.
+        :param batch_sampler: Sampler of the pair indices of each batch, sequential batches by default.
+        :param sparse_adjacency: Batches carry sparse adjacencies rather than edge indices (see collate_pairs).
+        """
+        self.graph_index_pairs = graph_index_pairs
+        self.graphs_1 = graphs_1
+        self.graphs_2 = graphs_2
+        if batch_sampler is None:
+            batch_sampler = BatchSampler(SequentialSampler(graph_index_pairs), batch_size, drop_last=False)
+        self.batch_sampler = batch_sampler
+        self.sparse_adjacency = sparse_adjacency
+        self.device = graphs_2[0]["node_features"].device
+        self.targets = torch.tensor([dataset.get_target(graph_index_pair, mode=mode)
+                                     for graph_index_pair in graph_index_pairs],
+                                    dtype=torch.float, device=self.device)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        for indices in self.batch_sampler:
+            graph_index_pairs = [self.graph_index_pairs[index] for index in indices]
+            batch = collate_pairs([join_graphs(self.graphs_1[i], self.graphs_2[j]) for i, j in graph_index_pairs],
+                                  sparse_adjacency=self.sparse_adjacency)
+            batch["target"] = self.targets[torch.tensor(indices, device=self.device)]
+            yield batch
+
+
+def stack_edge_indices(edge_indices, num_nodes):
+    """
+    Stacking the edge indices of several graphs into one block-diagonal edge index.
+    :param edge_indices: List of edge indices (2, num_edges).
+    :param num_nodes: List of node counts of the graphs.
+    :return edge_index: Edge index of the disjoint union of the graphs.
+    :return batch: Graph index of each node.
+    """
+    device = edge_indices[0].device
+    num_nodes = torch.tensor(num_nodes, dtype=torch.long, device=device)
+    num_edges = torch.tensor([index.size(1) for index in edge_indices], dtype=torch.long, device=device)
+    offsets = torch.cumsum(num_nodes, dim=0) - num_nodes
+
+    edge_index = torch.cat(edge_indices, dim=1) + torch.repeat_interleave(offsets, num_edges)
+    batch = torch.repeat_interleave(torch.arange(len(edge_indices), device=device), num_nodes)
+    return edge_index, batch
+
+
+def gcn_adjacency(edge_index, num_nodes):
+    """
+    Building the normalized adjacency matrix GCNConv propagates over, D^-1/2 (A + I) D^-1/2
+    with the missing self loops added and duplicate edges summed, as a sparse CSR tensor whose
+    row i holds the weights of the messages node i receives.
+    :param edge_index: Edge index (2, num_edges).
+    :param num_nodes: Number of nodes.
+    :return adj: Sparse CSR tensor (num_nodes, num_nodes).
+    """
+    edge_index, edge_weight = gcn_norm(edge_index, None, num_nodes, add_self_loops=True)
+    return to_torch_csr_tensor(edge_index.flip(0), edge_weight, size=(num_nodes, num_nodes))
+
+
+def collate_pairs(data_list, sparse_adjacency=True):
+    """
+    Merging graph pairs into one batch, PyG-style: the graphs on each side of the pairs are
+    stacked as the components of one big graph, "batch_*" maps every node to its pair and
+    "edge_batch_*" does the same for the nodes of the line graphs (the edges). "adj_*" and
+    "trans_adj_*" are the (transposed) adjacency matrices of the stacked graphs and line
+    graphs in CSR format, with the GCN normalization applied; without sparse_adjacency,
+    the stacked "edge_index_*" and "trans_edge_index_*" are given instead.
+    :param data_list: List of graph pairs: join_graphs of the Dataset.get_graph_tensors of both
+                      graphs, with an optional "target".
+    :param sparse_adjacency: Build the sparse adjacencies rather than keep the edge indices.
+    :return batch: Graph pair batch.
+    """
+    batch = dict()
+    for side in ("1", "2"):
+        node_features = [data["node_features_" + side] for data in data_list]
+        edge_features = [data["edge_features_" + side] for data in data_list]
+
+        batch["node_features_" + side] = torch.cat(node_features, dim=0)
+        batch["edge_features_" + side] = torch.cat(edge_features, dim=0)
+        edge_index, batch["batch_" + side] = \
+            stack_edge_indices([data["edge_index_" + side] for data in data_list],
+                               [features.size(0) for features in node_features])
+        trans_edge_index, batch["edge_batch_" + side] = \
+            stack_edge_indices([data["trans_edge_index_" + side] for data in data_list],
+                               [features.size(0) for features in edge_features])
+
+        if sparse_adjacency:
+            batch["adj_" + side] = gcn_adjacency(edge_index, batch["node_features_" + side].size(0))
+            batch["trans_adj_" + side] = gcn_adjacency(trans_edge_index, batch["edge_features_" + side].size(0))
+        else:
+            batch["edge_index_" + side] = edge_index
+            batch["trans_edge_index_" + side] = trans_edge_index
+
+    if "target" in data_list[0]:
+        batch["target"] = torch.cat([data["target"] for data in data_list])
+    return batch
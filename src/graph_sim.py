@@ -1,12 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import torch
 import numpy as np
 import torch.nn.functional as tnfunc
 from tqdm import tqdm, trange
 from scipy.stats import spearmanr, kendalltau
 
-from dataset import Dataset
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler, SequentialSampler
+from torch_geometric.utils import to_dense_batch
+
+from dataset import Dataset, DevicePairLoader, PairDataset, collate_pairs
 from layers import AvePoolingModule, AttentionModule, TenorNetworkModule, NodeGraphMatchingModule, MT_NEGCN
-from utils import calculate_loss
+from utils import calculate_loss, save_state_dict
 
 
 class GraphSim(torch.nn.Module):
@@ -37,86 +42,117 @@ class GraphSim(torch.nn.Module):
         self.convolution_0 = MT_NEGCN(self.args, self.number_node_labels, self.number_edge_labels)
 
         if self.args.attention_module:
-            self.attention = AttentionModule(self.args).to(self.args.device)
-            self.attention_edge = AttentionModule(self.args).to(self.args.device)
+            self.attention = AttentionModule(self.args)
+            self.attention_edge = AttentionModule(self.args)
         else:
-            self.avePooling = AvePoolingModule(self.args).to(self.args.device)
+            self.avePooling = AvePoolingModule(self.args)
 
-        self.tensor_network = TenorNetworkModule(self.args).to(self.args.device)
+        self.tensor_network = TenorNetworkModule(self.args)
 
         if self.args.node_graph_matching:
-            self.node_graph_matching = NodeGraphMatchingModule(self.args).to(self.args.device)
-
-        self.fully_connected_first = torch.nn.Linear(self.feature_count,
-                                                     self.args.bottle_neck_neurons).to(self.args.device)
-        self.scoring_layer = torch.nn.Linear(self.args.bottle_neck_neurons, 1).to(self.args.device)
-
-    def calculate_histogram(self, abstract_features_1, abstract_features_2):
-        n_1 = abstract_features_1.size(0)
-        n_2 = abstract_features_2.size(0)
-        if n_1 > n_2:
-            scores = torch.mm(
-                abstract_features_1,
-                torch.cat((
-                    abstract_features_2,
-                    torch.zeros((n_1 - n_2, abstract_features_2.size(1))).to(self.args.device)
-                ), dim=0).t().to(self.args.device)
-            ).detach().to(self.args.device)
-        elif n_1 < n_2:
-            scores = torch.mm(torch.cat(
-                (abstract_features_1, torch.zeros((n_2 - n_1, abstract_features_1.size(1))).to(self.args.device))).to(
-                self.args.device), abstract_features_2.t()).detach().to(self.args.device)
-        else:
-            scores = torch.mm(abstract_features_1, abstract_features_2.t()).detach().to(self.args.device)
-        scores = scores.view(-1, 1)
-        hist = torch.histc(scores, bins=self.args.bins).to(self.args.device)
-        hist = hist / torch.sum(hist)
-        hist = hist.view(1, -1)
+            self.node_graph_matching = NodeGraphMatchingModule(self.args)
+
+        self.fully_connected_first = torch.nn.Linear(self.feature_count, self.args.bottle_neck_neurons)
+        self.scoring_layer = torch.nn.Linear(self.args.bottle_neck_neurons, 1)
+
+    def calculate_histogram(self, abstract_features_1, batch_1, abstract_features_2, batch_2):
+        """
+        Histograms of the pairwise node similarities of every graph pair. As for torch.histc,
+        the bins span the range of each pair's scores; the smaller graph of a pair is padded
+        with zero embeddings, which adds zero scores to the pair's square score matrix.
+        """
+        features_1, mask_1 = to_dense_batch(abstract_features_1.float(), batch_1)
+        features_2, mask_2 = to_dense_batch(abstract_features_2.float(), batch_2)
+        batch_size = features_1.size(0)
+
+        # kept in full precision, half precision scores and counts would blur the bins
+        with torch.autocast(device_type=features_1.device.type, enabled=False):
+            scores = torch.bmm(features_1, features_2.transpose(1, 2)).view(batch_size, -1)
+        mask = (mask_1.unsqueeze(2) & mask_2.unsqueeze(1)).view(batch_size, -1)
+        n_1 = mask_1.sum(dim=1)
+        n_2 = mask_2.sum(dim=1)
+        padding = torch.max(n_1, n_2) ** 2 - n_1 * n_2
+
+        lower = scores.masked_fill(~mask, float("inf")).amin(dim=1)
+        upper = scores.masked_fill(~mask, float("-inf")).amax(dim=1)
+        lower = torch.where(padding > 0, lower.clamp(max=0), lower)
+        upper = torch.where(padding > 0, upper.clamp(min=0), upper)
+        flat = lower == upper
+        lower = torch.where(flat, lower - 1, lower).unsqueeze(1)
+        upper = torch.where(flat, upper + 1, upper).unsqueeze(1)
+
+        index = ((scores - lower) / (upper - lower) * self.args.bins).long().clamp(0, self.args.bins - 1)
+        zero_index = ((0 - lower) / (upper - lower) * self.args.bins).long().clamp(0, self.args.bins - 1)
+
+        hist = scores.new_zeros((batch_size, self.args.bins))
+        hist.scatter_add_(1, index, mask.to(hist.dtype))
+        hist.scatter_add_(1, zero_index, padding.unsqueeze(1).to(hist.dtype))
+        hist.div_(hist.sum(dim=1, keepdim=True).clamp_min(1e-12))
         return hist
 
     def forward(self, data):
 
-        abstract_features_1, edge_features_1 = self.convolution_0(data["node_features_1"], data["edge_index_1"],
-                                                                  data["edge_features_1"], data["trans_edge_index_1"])
-        abstract_features_2, edge_features_2 = self.convolution_0(data["node_features_2"], data["edge_index_2"],
-                                                                  data["edge_features_2"], data["trans_edge_index_2"])
-
-        if self.args.histogram:
-            hist = self.calculate_histogram(abstract_features_1, abstract_features_2)
+        # sparse adjacencies, or edge indices for the compiled model (see collate_pairs)
+        adjacency = "adj_" if "adj_1" in data else "edge_index_"
+        abstract_features_1, edge_features_1 = self.convolution_0(data["node_features_1"], data[adjacency + "1"],
+                                                                  data["edge_features_1"],
+                                                                  data["trans_" + adjacency + "1"])
+        abstract_features_2, edge_features_2 = self.convolution_0(data["node_features_2"], data[adjacency + "2"],
+                                                                  data["edge_features_2"],
+                                                                  data["trans_" + adjacency + "2"])
 
         if self.args.tensor_network:
             if self.args.attention_module:
 
-                pooled_edge_features_1 = self.attention_edge(edge_features_1)
-                pooled_edge_features_2 = self.attention_edge(edge_features_2)
-                pooled_features_1 = self.attention(abstract_features_1)
-                pooled_features_2 = self.attention(abstract_features_2)
+                pooled_edge_features_1 = self.attention_edge(edge_features_1, data["edge_batch_1"])
+                pooled_edge_features_2 = self.attention_edge(edge_features_2, data["edge_batch_2"])
+                pooled_features_1 = self.attention(abstract_features_1, data["batch_1"])
+                pooled_features_2 = self.attention(abstract_features_2, data["batch_2"])
             else:
-                pooled_features_1 = self.avePooling(abstract_features_1)
-                pooled_features_2 = self.avePooling(abstract_features_2)
-                pooled_edge_features_1 = self.avePooling(edge_features_1)
-                pooled_edge_features_2 = self.avePooling(edge_features_2)
-
-            scores_node = self.tensor_network(pooled_features_1, pooled_features_2)
-            scores_edge = self.tensor_network(pooled_edge_features_1, pooled_edge_features_2)
-            scores = torch.t(torch.cat((scores_node, scores_edge), dim=0))
+                pooled_features_1 = self.avePooling(abstract_features_1, data["batch_1"])
+                pooled_features_2 = self.avePooling(abstract_features_2, data["batch_2"])
+                pooled_edge_features_1 = self.avePooling(edge_features_1, data["edge_batch_1"])
+                pooled_edge_features_2 = self.avePooling(edge_features_2, data["edge_batch_2"])
+            batch_size = pooled_features_1.size(0)
+        else:
+            # number of pairs, as the pooling layers count them
+            batch_size = int(data["batch_1"].max()) + 1
 
-            if self.args.histogram:
-                scores = torch.cat((scores, hist), dim=1).view(1, -1)
+        # the bottleneck features are written in place, in the layout of calculate_bottleneck_features:
+        # [tensor network scores of nodes | of edges | histogram | node-graph matching scores]
+        tensor_layer_out = self.args.tensor_neurons * 2
+        if self.args.tensor_network:
+            scores = abstract_features_1.new_empty((batch_size, self.feature_count))
         else:
-            scores = hist.view(1, -1)
+            scores = abstract_features_1.new_zeros((batch_size, self.feature_count))
+
+        if self.args.histogram:
+            scores[:, tensor_layer_out: tensor_layer_out + self.args.bins] = \
+                self.calculate_histogram(abstract_features_1, data["batch_1"], abstract_features_2, data["batch_2"])
+
+        if self.args.tensor_network:
+            # node and edge representations share the tensor network, thus go through it in one call
+            tensor_scores = self.tensor_network(torch.cat((pooled_features_1, pooled_edge_features_1), dim=0),
+                                                torch.cat((pooled_features_2, pooled_edge_features_2), dim=0))
+            scores[:, :self.args.tensor_neurons] = tensor_scores[:batch_size]
+            scores[:, self.args.tensor_neurons: tensor_layer_out] = tensor_scores[batch_size:]
 
         if self.args.node_graph_matching:
             # node-graph sub-network
-            node_graph_score = self.node_graph_matching(abstract_features_1, abstract_features_2)
-            scores = torch.cat((scores, node_graph_score), dim=1).view(1, -1)
+            scores[:, self.feature_count - self.args.hidden_size * 4:] = \
+                self.node_graph_matching(abstract_features_1, data["batch_1"], abstract_features_2, data["batch_2"])
 
         scores = tnfunc.relu(self.fully_connected_first(scores))
         score = torch.sigmoid(self.scoring_layer(scores))
-        return score
+        return score.view(-1)
 
 
 class GraphSimTrainer(object):
+    # weights which Parameter(...).to(device) left unregistered on GPU, thus absent from older checkpoints
+    legacy_missing_keys = ("attention.weight_matrix", "attention_edge.weight_matrix",
+                           "tensor_network.weight_matrix", "tensor_network.weight_matrix_block",
+                           "tensor_network.bias", "node_graph_matching.mp_w")
+
     def __init__(self, args):
         self.args = args
 
@@ -137,46 +173,118 @@ class GraphSimTrainer(object):
         self.model = GraphSim(self.args, self.dataset.number_of_node_labels, self.dataset.number_of_edge_labels) \
             .to(self.args.device)
 
-    def create_batches(self):
-        batches = []
-        for graph_pair_index in range(0, len(self.dataset.training_graph_index_pairs), self.args.batch_size):
-            batches.append(
-                self.dataset.training_graph_index_pairs[graph_pair_index: graph_pair_index + self.args.batch_size])
-        return batches
+        # the compiled wrapper shares its parameters with self.model, which is kept
+        # for train/eval switching and (de)serialization of the state dict
+        if self.args.compile_model:
+            # node counts vary from one batch to another
+            torch._dynamo.config.cache_size_limit = 256
+            self.compiled_model = torch.compile(self.model, mode="max-autotune-no-cudagraphs",
+                                                dynamic=True, fullgraph=False)
+        else:
+            self.compiled_model = self.model
+        # torch.compile does not trace sparse tensors: the compiled model propagates over edge indices
+        self.sparse_adjacency = not self.args.compile_model
+
+        # reshuffled at each pass, one epoch after another
+        self.sampler = BatchSampler(RandomSampler(self.dataset.training_graph_index_pairs),
+                                    batch_size=self.args.batch_size, drop_last=False)
+
+        # test pairs are ordered by query graph: each test batch scores one query against all training graphs
+        if self.args.device_resident:
+            self.create_device_loaders()
+        else:
+            self.training_loader = self.create_loader(self.dataset.training_graph_index_pairs, mode="training",
+                                                      batch_sampler=self.sampler)
+            if self.args.validate:
+                self.validation_loader = self.create_loader(self.dataset.validation_graph_index_pairs,
+                                                            mode="validation")
+            self.test_loader = self.create_loader(self.dataset.test_graph_index_pairs, mode="test",
+                                                  batch_size=len(self.dataset.training_graphs))
+
+    def create_device_loaders(self):
+        # every graph is converted and uploaded once, pairs are then assembled on the device
+        training_graphs = [self.to_device(self.dataset.get_graph_tensors(graph))
+                           for graph in self.dataset.training_graphs]
+        test_graphs = [self.to_device(self.dataset.get_graph_tensors(graph)) for graph in self.dataset.test_graphs]
+
+        self.training_loader = DevicePairLoader(self.dataset, self.dataset.training_graph_index_pairs,
+                                                training_graphs, training_graphs, mode="training",
+                                                batch_sampler=self.sampler, sparse_adjacency=self.sparse_adjacency)
+        if self.args.validate:
+            self.validation_loader = DevicePairLoader(self.dataset, self.dataset.validation_graph_index_pairs,
+                                                      training_graphs, training_graphs, mode="validation",
+                                                      batch_size=self.args.batch_size,
+                                                      sparse_adjacency=self.sparse_adjacency)
+        self.test_loader = DevicePairLoader(self.dataset, self.dataset.test_graph_index_pairs,
+                                            test_graphs, training_graphs, mode="test",
+                                            batch_size=len(self.dataset.training_graphs),
+                                            sparse_adjacency=self.sparse_adjacency)
+
+    def create_loader(self, graph_index_pairs, mode="training", batch_size=None, batch_sampler=None):
+        # pairs are assembled by the workers while the model runs on the previous batch,
+        # persistent workers also keep their memoized graph tensors from one epoch to the next
+        worker_args = dict()
+        if self.args.num_workers > 0:
+            worker_args["persistent_workers"] = True
+            worker_args["prefetch_factor"] = 2
+        if batch_sampler is None:
+            batch_sampler = BatchSampler(SequentialSampler(graph_index_pairs),
+                                         batch_size=batch_size or self.args.batch_size, drop_last=False)
+        return DataLoader(PairDataset(self.dataset, graph_index_pairs, mode=mode),
+                          batch_sampler=batch_sampler,
+                          collate_fn=partial(collate_pairs, sparse_adjacency=self.sparse_adjacency),
+                          num_workers=self.args.num_workers,
+                          pin_memory=self.args.device.type == "cuda",
+                          **worker_args)
+
+    def to_device(self, data):
+        return {key: value.to(self.args.device, non_blocking=True) for key, value in data.items()}
+
+    def predict(self, data):
+        # bfloat16 has the range of float32, thus no gradient scaling is needed;
+        # on CPU autocast only adds casts, so the model runs in full precision there
+        with torch.autocast(device_type="cuda", dtype=torch.bfloat16,
+                            enabled=self.args.mixed_precision and self.args.device.type == "cuda"):
+            prediction = self.compiled_model(data)
+        return prediction.float()
 
     def process_batch(self, batch):
-        self.optimizer.zero_grad()
-        losses = 0
-        for graph_index_pair in batch:
-            data = self.dataset.get_data(graph_index_pair, mode="training")
-            data = self.dataset.transfer_to_torch(data)
-            prediction = self.model(data)
-            losses = losses + tnfunc.mse_loss(data["target"], prediction)
-        losses.backward(retain_graph=True)
+        self.optimizer.zero_grad(set_to_none=True)
+        data = self.to_device(batch)
+        prediction = self.predict(data)
+        # summed rather than averaged, to keep the gradient scale of the former per pair accumulation
+        losses = tnfunc.mse_loss(prediction, data["target"], reduction="sum")
+        losses.backward()
         self.optimizer.step()
         loss = losses.item()
         return loss
 
     def validate(self, index):
-        from utils import calculate_normalized_ged
         self.model.eval()
         print("\n\nModel evaluation.\n")
         scores = []
-        ground_truth = []
-        for graph_index_pair in tqdm(self.dataset.validation_graph_index_pairs):
-            data = self.dataset.get_data(graph_index_pair, mode="validation")
-            ground_truth.append(calculate_normalized_ged(data))
-            data = self.dataset.transfer_to_torch(data)
-            target = data["target"]
-            prediction = self.model(data)
-            scores.append(calculate_loss(prediction, target))
-        model_error = np.mean(scores)
+        with torch.inference_mode():
+            for data in tqdm(self.validation_loader):
+                data = self.to_device(data)
+                target = data["target"]
+                prediction = self.predict(data)
+                scores.append(calculate_loss(prediction, target))
+        # one device sync for the whole validation set
+        model_error = torch.cat(scores).mean().item()
         self.epoch_loss_list.append(model_error)
         print("\nModel validate error: " + str(round(float(model_error), 5)) + ".")
         if model_error < self.min_error:
             self.best_epoch_index = index
             self.min_error = model_error
-            torch.save(self.model.state_dict(), self.args.best_model_path)
+            self.save_best_model()
+
+    def save_best_model(self):
+        # the snapshot is written by a background thread while training goes on;
+        # result() waits for the previous save and re-raises its error, if any
+        state_dict = {key: value.detach().clone() for key, value in self.model.state_dict().items()}
+        if self.save_future is not None:
+            self.save_future.result()
+        self.save_future = self.save_executor.submit(save_state_dict, state_dict, self.args.best_model_path)
 
     def train(self):
         print("\nModel training.\n")
@@ -186,27 +294,30 @@ class GraphSimTrainer(object):
                                           weight_decay=self.args.weight_decay)
 
         epochs = trange(self.args.epochs, leave=True, desc="Epoch")
-        self.model.to(self.args.device)
 
         self.min_error = 100
-        self.best_model = None
         self.best_epoch_index = 0
         self.epoch_loss_list = []
+        self.save_executor = ThreadPoolExecutor(max_workers=1)
+        self.save_future = None
 
         for epoch_index, epoch in enumerate(epochs):
             self.model.train()
-            batches = self.create_batches()
             self.loss_sum = 0
             main_index = 0
-            for batch in tqdm(batches, total=len(batches), desc="Batches"):
+            for batch in tqdm(self.training_loader, desc="Batches"):
                 loss_score = self.process_batch(batch)
-                main_index = main_index + len(batch)
-                self.loss_sum = self.loss_sum + loss_score * len(batch)
+                batch_size = batch["target"].size(0)
+                main_index = main_index + batch_size
+                self.loss_sum = self.loss_sum + loss_score * batch_size
                 loss = self.loss_sum / main_index
                 epochs.set_description("Epoch (Loss=%g)" % round(loss, 5))
             if self.args.validate:
                 self.validate(epoch_index)
 
+        if self.save_future is not None:
+            self.save_future.result()
+        self.save_executor.shutdown()
         if self.args.validate:
             self.model.load_state_dict(torch.load(self.args.best_model_path))
 
@@ -216,31 +327,25 @@ class GraphSimTrainer(object):
         print("\n\nModel testing.\n")
         self.model.eval()
 
-        scores = np.zeros(len(self.dataset.test_graph_index_pairs))
-        self.ground_truth = np.zeros(len(self.dataset.test_graph_index_pairs))
-        self.prediction_list = np.zeros(len(self.dataset.test_graph_index_pairs))
-        prec_at_10_list = []
-        prec_at_20_list = []
-        temp_gt = []
-        temp_pre = []
-
-        for index, test_index_pair in tqdm(enumerate(self.dataset.test_graph_index_pairs)):
-            data = self.dataset.get_data(test_index_pair, mode="test")
-            data = self.dataset.transfer_to_torch(data)
-            target = data["target"]
-            self.ground_truth[index] = target
-            prediction = self.model(data)
-            self.prediction_list[index] = prediction
-            scores[index] = calculate_loss(prediction, target)
-            temp_gt.append(target.item())
-            temp_pre.append(prediction.item())
-            if (index + 1) % len(self.dataset.test_graphs) == 0:
-                np_batch_gt = np.array(temp_gt)
-                np_batch_p = np.array(temp_pre)
-                prec_at_10_list.append(prec_at_ks(np_batch_gt, np_batch_p, 10))
-                prec_at_20_list.append(prec_at_ks(np_batch_gt, np_batch_p, 20))
-                temp_gt.clear()
-                temp_pre.clear()
+        # predictions stay on the device until the end, to copy them (and synchronize) only once
+        targets = []
+        predictions = []
+        with torch.inference_mode():
+            for data in tqdm(self.test_loader):
+                data = self.to_device(data)
+                targets.append(data["target"])
+                predictions.append(self.predict(data))
+        self.ground_truth = torch.cat(targets).cpu().numpy()
+        self.prediction_list = torch.cat(predictions).cpu().numpy()
+        scores = (self.prediction_list - self.ground_truth) ** 2
+
+        # precisions over consecutive blocks of len(test_graphs) pairs, an incomplete last block is left out
+        block_size = len(self.dataset.test_graphs)
+        block_count = len(self.ground_truth) // block_size
+        gt_blocks = self.ground_truth[:block_count * block_size].reshape(block_count, block_size)
+        p_blocks = self.prediction_list[:block_count * block_size].reshape(block_count, block_size)
+        prec_at_10_list = [prec_at_ks(block_gt, block_p, 10) for block_gt, block_p in zip(gt_blocks, p_blocks)]
+        prec_at_20_list = [prec_at_ks(block_gt, block_p, 20) for block_gt, block_p in zip(gt_blocks, p_blocks)]
 
         mse = np.mean(scores)
         rho = calculate_ranking_correlation(spearmanr, self.prediction_list, self.ground_truth)
@@ -252,8 +357,8 @@ class GraphSimTrainer(object):
     def print_evaluation(self, mse, rho, tau, prec_at_20, prec_at_10):
         mean_ground_truth = np.mean(self.ground_truth)
         mean_predicted = np.mean(self.prediction_list)
-        delta = np.mean([(n - mean_ground_truth) ** 2 for n in self.ground_truth])
-        predicted_delta = np.mean([(n - mean_predicted) ** 2 for n in self.prediction_list])
+        delta = np.mean((self.ground_truth - mean_ground_truth) ** 2)
+        predicted_delta = np.mean((self.prediction_list - mean_predicted) ** 2)
 
         print("\nGround truth delta: " + str(round(float(delta), 8)) + ".")
         print("\nGround truth mean: " + str(round(float(mean_ground_truth), 8)) + ".")
@@ -276,4 +381,13 @@ class GraphSimTrainer(object):
         torch.save(self.model.state_dict(), path)
 
     def load(self):
-        self.model.load_state_dict(torch.load(self.args.load_path))
+        state_dict = torch.load(self.args.load_path)
+        # GPU checkpoints saved before these weights were registered as parameters lack them,
+        # they are then left at their initialization; any other mismatch fails the strict load
+        model_state_dict = self.model.state_dict()
+        missing_keys = [key for key in self.legacy_missing_keys if key in model_state_dict and key not in state_dict]
+        if missing_keys:
+            print("\nWarning: keys missing from " + self.args.load_path + ", left initialized: " +
+                  ", ".join(missing_keys))
+            state_dict.update({key: model_state_dict[key] for key in missing_keys})
+        self.model.load_state_dict(state_dict)
@@ -2,11 +2,13 @@
 import torch
 import torch.nn.functional as tnfunc
 from torch.nn import Module
+from torch.nn.utils.rnn import pack_padded_sequence
 from torch.nn.parameter import Parameter
 import numpy as np
 import math
 
-from torch_geometric.nn import GCNConv
+from torch_geometric.nn import GCNConv, global_add_pool, global_mean_pool
+from torch_geometric.utils import to_dense_batch
 
 
 class AvePoolingModule(Module):
@@ -15,8 +17,8 @@ class AvePoolingModule(Module):
         super(AvePoolingModule, self).__init__()
         self.args = args
 
-    def forward(self, embedding):
-        return torch.mean(embedding, dim=0).view(-1, 1).to(self.args.device)
+    def forward(self, embedding, batch):
+        return global_mean_pool(embedding, batch)
 
 
 class AttentionModule(Module):
@@ -35,7 +37,7 @@ class AttentionModule(Module):
         Defining weights.
         """
         self.weight_matrix = torch.nn.Parameter(torch.Tensor(self.args.embedding_out,
-                                                             self.args.embedding_out)).to(self.args.device)
+                                                             self.args.embedding_out))
 
     def init_parameters(self):
         """
@@ -43,11 +45,16 @@ class AttentionModule(Module):
         """
         torch.nn.init.xavier_uniform_(self.weight_matrix)
 
-    def forward(self, embedding):
-        global_context = torch.mean(torch.matmul(embedding, self.weight_matrix), dim=0).to(self.args.device)
-        transformed_global = torch.tanh(global_context).to(self.args.device)
-        sigmoid_scores = torch.sigmoid(torch.mm(embedding, transformed_global.view(-1, 1))).to(self.args.device)
-        representation = torch.mm(torch.t(embedding), sigmoid_scores).to(self.args.device)
+    def forward(self, embedding, batch):
+        """
+        :param embedding: Node embeddings of every graph in the batch.
+        :param batch: Graph index of each node.
+        :return representation: Graph level representations (batch, embedding_out).
+        """
+        global_context = global_mean_pool(torch.matmul(embedding, self.weight_matrix), batch)
+        transformed_global = torch.tanh(global_context)
+        sigmoid_scores = torch.sigmoid(torch.sum(embedding * transformed_global[batch], dim=1, keepdim=True))
+        representation = global_add_pool(embedding * sigmoid_scores, batch)
         return representation
 
 
@@ -72,10 +79,10 @@ class TenorNetworkModule(Module):
         """
         self.weight_matrix = torch.nn.Parameter(torch.Tensor(self.nfeature_in,
                                                              self.nfeature_in,
-                                                             self.args.tensor_neurons)).to(self.args.device)
+                                                             self.args.tensor_neurons))
         self.weight_matrix_block = torch.nn.Parameter(torch.Tensor(self.args.tensor_neurons,
-                                                                       2 * self.nfeature_in)).to(self.args.device)
-        self.bias = torch.nn.Parameter(torch.Tensor(self.args.tensor_neurons, 1)).to(self.args.device)
+                                                                       2 * self.nfeature_in))
+        self.bias = torch.nn.Parameter(torch.Tensor(self.args.tensor_neurons, 1))
 
     def init_parameters(self):
 
@@ -84,15 +91,16 @@ class TenorNetworkModule(Module):
         torch.nn.init.xavier_uniform_(self.bias)
 
     def forward(self, embedding_1, embedding_2):
-
-        scoring = torch.mm(torch.t(embedding_1), self.weight_matrix.view(self.nfeature_in, -1)).to(
-            self.args.device)
-        scoring = scoring.view(self.nfeature_in, self.args.tensor_neurons).to(self.args.device)
-
-        scoring = torch.mm(torch.t(scoring), embedding_2).to(self.args.device)
-        combined_representation = torch.cat((embedding_1, embedding_2)).to(self.args.device)
-        block_scoring = torch.mm(self.weight_matrix_block, combined_representation).to(self.args.device)
-        scores = tnfunc.relu(scoring + block_scoring + self.bias).to(self.args.device)
+        """
+        :param embedding_1: Graph level representations of the first graphs (batch, nfeature_in).
+        :param embedding_2: Graph level representations of the second graphs (batch, nfeature_in).
+        :return scores: Similarity vectors (batch, tensor_neurons).
+        """
+        # scoring[b, k] = embedding_1[b]^T weight_matrix[:, :, k] embedding_2[b]
+        scoring = torch.einsum("bi,ijk,bj->bk", embedding_1, self.weight_matrix, embedding_2)
+        combined_representation = torch.cat((embedding_1, embedding_2), dim=1)
+        block_scoring = torch.mm(combined_representation, torch.t(self.weight_matrix_block))
+        scores = tnfunc.relu(scoring + block_scoring + self.bias.view(1, -1))
         return scores
 
 
@@ -108,12 +116,12 @@ class NodeGraphMatchingModule(Module):
         # trainable weight matrix for multi-perspective matching function
         self.mp_w = torch.nn.Parameter(
             torch.Tensor(self.args.perspectives, self.args.embedding_out)
-        ).to(self.args.device)
+        )
 
         # Aggregation Layer
         self.agg_bilstm = torch.nn.LSTM(input_size=self.args.perspectives, hidden_size=self.args.hidden_size,
                                         num_layers=1,
-                                        bidirectional=True, batch_first=True).to(self.args.device)
+                                        bidirectional=True, batch_first=True)
 
     def init_parameters(self):
         torch.nn.init.xavier_uniform_(self.mp_w)
@@ -125,53 +133,55 @@ class NodeGraphMatchingModule(Module):
 
     def cosine_attention(self, v1, v2):
         # (batch, len1, len2)
-        a = torch.bmm(v1, v2.permute(0, 2, 1)).to(self.args.device)
+        a = torch.bmm(v1, v2.permute(0, 2, 1))
 
-        v1_norm = v1.norm(p=2, dim=2, keepdim=True).to(self.args.device)  # (batch, len1, 1)
-        v2_norm = v2.norm(p=2, dim=2, keepdim=True).permute(0, 2, 1).to(self.args.device)  # (batch, len2, 1)
+        v1_norm = v1.norm(p=2, dim=2, keepdim=True)  # (batch, len1, 1)
+        v2_norm = v2.norm(p=2, dim=2, keepdim=True).permute(0, 2, 1)  # (batch, len2, 1)
         d = v1_norm * v2_norm
         return self.div_with_small_value(a, d)
 
     def multi_perspective_match_func(self, v1, v2, w):
-        w = w.transpose(1, 0).unsqueeze(0).unsqueeze(0).to(self.args.device)  # (1,      1,  dim, perspectives)
-        v1 = w * torch.stack([v1] * self.args.perspectives, dim=3).to(
-            self.args.device)  # (batch, len, dim, perspectives)
-        v2 = w * torch.stack([v2] * self.args.perspectives, dim=3).to(
-            self.args.device)  # (batch, len, dim, perspectives)
-        return tnfunc.cosine_similarity(v1, v2, dim=2).to(self.args.device)  # (batch, len, perspectives)
-
-    def forward(self, feature_p, feature_h):
-        feature_p = feature_p.unsqueeze(0).to(self.args.device)
-        feature_h = feature_h.unsqueeze(0).to(self.args.device)
+        w = w.transpose(1, 0).unsqueeze(0).unsqueeze(0)  # (1,      1,  dim, perspectives)
+        v1 = w * torch.stack([v1] * self.args.perspectives, dim=3)  # (batch, len, dim, perspectives)
+        v2 = w * torch.stack([v2] * self.args.perspectives, dim=3)  # (batch, len, dim, perspectives)
+        return tnfunc.cosine_similarity(v1, v2, dim=2)  # (batch, len, perspectives)
+
+    def forward(self, feature_p, batch_p, feature_h, batch_h):
+        # padded rows are all-zero, so they get zero attention and zero matching scores,
+        # and the packed sequences below keep them out of the BiLSTM
+        feature_p, mask_p = to_dense_batch(feature_p, batch_p)  # (batch, len_p, dim)
+        feature_h, mask_h = to_dense_batch(feature_h, batch_h)  # (batch, len_h, dim)
         # ---------- Node-Graph Matching Layer ----------
-        attention = self.cosine_attention(feature_p, feature_h).to(self.args.device)  # (batch, len_p, len_h)
+        attention = self.cosine_attention(feature_p, feature_h)  # (batch, len_p, len_h)
 
         # (batch, 1, len_h, dim) * (batch, len_p, len_h, dim) => (batch, len_p, len_h, dim)
-        attention_h = feature_h.unsqueeze(1) * attention.unsqueeze(3).to(self.args.device)
+        attention_h = feature_h.unsqueeze(1) * attention.unsqueeze(3)
         # (batch, len_p, 1, dim) * (batch, len_p, len_h, dim) => (batch, len_p, len_h, dim)
-        attention_p = feature_p.unsqueeze(2) * attention.unsqueeze(3).to(self.args.device)
+        attention_p = feature_p.unsqueeze(2) * attention.unsqueeze(3)
 
         att_mean_h = self.div_with_small_value(attention_h.sum(dim=2),
-                                               attention.sum(dim=2, keepdim=True)).to(
-            self.args.device)  # (batch, len_p, dim)
+                                               attention.sum(dim=2, keepdim=True))  # (batch, len_p, dim)
         att_mean_p = self.div_with_small_value(attention_p.sum(dim=1),
-                                               attention.sum(dim=1, keepdim=True).permute(0, 2, 1)).to(self.args.device)
+                                               attention.sum(dim=1, keepdim=True).permute(0, 2, 1))
 
         # Matching Layer
-        multi_p = self.multi_perspective_match_func(v1=feature_p, v2=att_mean_h, w=self.mp_w).to(self.args.device)
-        multi_h = self.multi_perspective_match_func(v1=feature_h, v2=att_mean_p, w=self.mp_w).to(self.args.device)
+        multi_p = self.multi_perspective_match_func(v1=feature_p, v2=att_mean_h, w=self.mp_w)
+        multi_h = self.multi_perspective_match_func(v1=feature_h, v2=att_mean_p, w=self.mp_w)
 
         match_p = multi_p
         match_h = multi_h
 
+        match_p = pack_padded_sequence(match_p, mask_p.sum(dim=1).cpu(), batch_first=True, enforce_sorted=False)
+        match_h = pack_padded_sequence(match_h, mask_h.sum(dim=1).cpu(), batch_first=True, enforce_sorted=False)
+
         # Aggregation Layer
         _, (agg_p_last, _) = self.agg_bilstm(match_p)  # (batch, seq_len, l) -> (2, batch, hidden_size)
-        agg_p = agg_p_last.permute(1, 0, 2).contiguous().view(-1, self.args.hidden_size * 2).to(self.args.device)
+        agg_p = agg_p_last.permute(1, 0, 2).contiguous().view(-1, self.args.hidden_size * 2)
 
         _, (agg_h_last, _) = self.agg_bilstm(match_h)
-        agg_h = agg_h_last.permute(1, 0, 2).contiguous().view(-1, self.args.hidden_size * 2).to(self.args.device)
+        agg_h = agg_h_last.permute(1, 0, 2).contiguous().view(-1, self.args.hidden_size * 2)
 
-        x = torch.cat([agg_p, agg_h], dim=1).to(self.args.device)
+        x = torch.cat([agg_p, agg_h], dim=1)
         return x
 
 
@@ -368,30 +378,48 @@ class MT_NEGCN(Module):
         self.edge_GCN_2 = GCNConv(self.args.edge_nhid_1, self.args.edge_nhid_2)
         self.edge_GCN_3 = GCNConv(self.args.edge_nhid_2, self.args.edge_nhid_3)
 
-    def forward(self, feature_v, edge_index, feature_e, trans_edge_index):
-        feature_v = self.node_GCN_1(feature_v, edge_index)
+    def graph_convolution(self, conv, feature, adj):
+        """
+        GCNConv over a precomputed normalized adjacency (see dataset.gcn_adjacency): one
+        sparse-dense product instead of gathering and scattering messages along edge_index.
+        Given an edge index instead, the layer runs as usual.
+        :param conv: GCNConv layer, whose weights and bias are used.
+        :param feature: Node features.
+        :param adj: Normalized sparse CSR adjacency, or edge index.
+        :return feature: Convolved node features.
+        """
+        if adj.layout != torch.sparse_csr:
+            return conv(feature, adj)
+        feature = conv.lin(feature)
+        # sparse products have no half precision kernels on every device
+        with torch.autocast(device_type=feature.device.type, enabled=False):
+            feature = torch.sparse.mm(adj, feature.to(adj.dtype))
+        return feature + conv.bias
+
+    def forward(self, feature_v, adj, feature_e, trans_adj):
+        feature_v = self.graph_convolution(self.node_GCN_1, feature_v, adj)
         feature_v = tnfunc.relu(feature_v)
-        feature_e = self.edge_GCN_1(feature_e, trans_edge_index)
+        feature_e = self.graph_convolution(self.edge_GCN_1, feature_e, trans_adj)
         feature_e = tnfunc.relu(feature_e)
 
-        feature_v_share = self.share_layer_1(feature_v, edge_index)
+        feature_v_share = self.graph_convolution(self.share_layer_1, feature_v, adj)
         feature_v_share = tnfunc.relu(feature_v_share)
-        feature_e_share = self.share_layer_1(feature_e, trans_edge_index)
+        feature_e_share = self.graph_convolution(self.share_layer_1, feature_e, trans_adj)
         feature_e_share = tnfunc.relu(feature_e_share)
 
-        feature_v_share = self.share_layer_2(feature_v_share, edge_index)
+        feature_v_share = self.graph_convolution(self.share_layer_2, feature_v_share, adj)
         feature_v_share = tnfunc.relu(feature_v_share)
-        feature_e_share = self.share_layer_2(feature_e_share, trans_edge_index)
+        feature_e_share = self.graph_convolution(self.share_layer_2, feature_e_share, trans_adj)
         feature_e_share = tnfunc.relu(feature_e_share)
 
-        feature_v = self.node_GCN_2(feature_v, edge_index)
+        feature_v = self.graph_convolution(self.node_GCN_2, feature_v, adj)
         feature_v = tnfunc.relu(feature_v)
-        feature_v = self.node_GCN_3(feature_v, edge_index)
+        feature_v = self.graph_convolution(self.node_GCN_3, feature_v, adj)
         feature_v = tnfunc.relu(feature_v)
 
-        feature_e = self.edge_GCN_2(feature_e, trans_edge_index)
+        feature_e = self.graph_convolution(self.edge_GCN_2, feature_e, trans_adj)
         feature_e = tnfunc.relu(feature_e)
-        feature_e = self.edge_GCN_3(feature_e, trans_edge_index)
+        feature_e = self.graph_convolution(self.edge_GCN_3, feature_e, trans_adj)
         feature_e = tnfunc.relu(feature_e)
 
         feature_v = torch.cat((feature_v, feature_v_share), dim=1)
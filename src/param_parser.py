@@ -1,6 +1,19 @@
 import argparse
 
 
+def str_to_bool(value):
+    """
+    Parsing an on/off option given as "True" or "False" on the command line.
+    :param value: Option value.
+    :return: Boolean value of the option.
+    """
+    if value.lower() in ("true", "1", "yes"):
+        return True
+    if value.lower() in ("false", "0", "no"):
+        return False
+    raise argparse.ArgumentTypeError("Boolean value expected, got " + value + ".")
+
+
 def parameter_parser():
 
     parser = argparse.ArgumentParser()
@@ -97,6 +110,16 @@ def parameter_parser():
     parser.add_argument("--node-graph-matching",
                         default=True)
 
+    parser.add_argument("--compile-model",
+                        type=str_to_bool,
+                        default=False,
+                        help="Compile the model with torch.compile (Inductor max-autotune). Default is False.")
+
+    parser.add_argument("--mixed-precision",
+                        type=str_to_bool,
+                        default=True,
+                        help="Run the model under bfloat16 autocast on CUDA devices. Default is True.")
+
     """
     experiment settings
     """
@@ -123,6 +146,17 @@ def parameter_parser():
     parser.add_argument("--validate",
                         default=True)
 
+    parser.add_argument("--device-resident",
+                        type=str_to_bool,
+                        default=True,
+                        help="Upload the whole dataset to the device once, instead of loading "
+                             "graph pairs with DataLoader workers. Default is True.")
+
+    parser.add_argument("--num-workers",
+                        type=int,
+                        default=4,
+                        help="Number of DataLoader workers preparing graph pairs. Default is 4.")
+
     """ 
     dataset settings
     """
@@ -1,5 +1,6 @@
 from texttable import Texttable
 import numpy as np
+from scipy.stats import rankdata
 
 
 def get_file_id_from_path(path):
@@ -32,24 +33,29 @@ def tab_printer(args):
 def calculate_loss(prediction, target):
     """
     Calculating the squared loss on the normalized GED.
-    :param prediction: Predicted log value of GED.
-    :param target: Factual log transformed GED.
-    :return score: Squared error.
+    :param prediction: Predicted log values of GED.
+    :param target: Factual log transformed GEDs.
+    :return score: Squared errors (on the device of the inputs).
     """
     # prediction = -math.log(prediction)
     # target = -math.log(target)
     score = (prediction-target)**2
-    return score.item()
+    return score.detach()
 
 
-def calculate_normalized_ged(data):
+def save_state_dict(state_dict, path):
     """
-    Calculating the normalized GED for a pair of graphs.
-    :param data: Data table.
-    :return norm_ged: Normalized GED score.
+    Saving a state dict through a temporary file, so that an interrupted save never leaves
+    a truncated model at path.
+    :param state_dict: State dict of the model.
+    :param path: Where to save the model.
     """
-    norm_ged = data["ged"]/(0.5*(len(data["node_labels_1"])+len(data["node_labels_2"])))
-    return norm_ged
+    import os
+    import torch
+
+    temp_path = path + ".tmp"
+    torch.save(state_dict, temp_path)
+    os.replace(temp_path, path)
 
 
 def get_data_from_path_pair(path_pair, ged_dic):
@@ -134,22 +140,12 @@ def get_data_from_path(path, dataset_name="LINUX"):
 
 
 def ranking_func(data):
-    sort_id_mat = np.argsort(-data)
-    n = sort_id_mat.shape[0]
-    rank = np.zeros(n)
-    for i in range(n):
-        finds = np.where(sort_id_mat == i)
-        fid = finds[0][0]
-        while fid > 0:
-            cid = sort_id_mat[fid]
-            pid = sort_id_mat[fid - 1]
-            if data[pid] == data[cid]:
-                fid -= 1
-            else:
-                break
-        rank[i] = fid + 1
-
-    return rank
+    """
+    Ranking values in descending order, tied values sharing their smallest rank.
+    :param data: Vector of values.
+    :return rank: Vector of ranks (1 for the largest value).
+    """
+    return rankdata(-data, method="min")
 
 
 def calculate_ranking_correlation(rank_corr_function, prediction, target):